@@ -1,66 +1,126 @@
 import os
+import re
+from functools import lru_cache
 from dotenv import load_dotenv
-from crewai import Agent
+import httpx
+from crewai import Agent, LLM
 from crewai.tools import tool
-from langchain_ollama import ChatOllama
+from litellm.llms.custom_httpx.http_handler import HTTPHandler
 
 
 load_dotenv()
 
 # ---------- TOOLS ----------
 
-@tool("Analyze Blood Report for Nutrition Guidance")
-def analyze_nutrition(blood_report: str) -> str:
-    """Reviews blood test data and returns dietary suggestions based on identified biomarker patterns."""
-    suggestions = []
-    report_lower = blood_report.lower()
-    
-    if "cholesterol" in report_lower or "lipid" in report_lower or "triglycerides" in report_lower:
-        suggestions.append("For elevated lipid markers: Reduce saturated fats and increase soluble fiber (oats, legumes, fruits).")
-    
-    if "hemoglobin" in report_lower or "ferritin" in report_lower or "iron" in report_lower:
-        suggestions.append("For low iron markers: Prioritize iron-rich foods like spinach, lentils, or lean proteins, paired with Vitamin C for better absorption.")
-    
-    if "vitamin d" in report_lower or "25-hydroxy" in report_lower:
-        suggestions.append("For Vitamin D concerns: Include fortified dairy, egg yolks, and fatty fish. Consider safe sun exposure.")
+# Flags raised by the keyword scan; each keyword maps to every suggestion it triggers.
+NUTRITION_LIPIDS = 1 << 0
+NUTRITION_IRON = 1 << 1
+NUTRITION_VITAMIN_D = 1 << 2
+NUTRITION_GLUCOSE = 1 << 3
+EXERCISE_LIPIDS = 1 << 4
+EXERCISE_IRON = 1 << 5
+EXERCISE_GLUCOSE = 1 << 6
+VERIFY_REFERENCE_RANGE = 1 << 7
+VERIFY_RESULT = 1 << 8
+VERIFY_UNITS = 1 << 9
+VERIFY_LAB = 1 << 10
+VERIFY_HEMOGLOBIN = 1 << 11
+VERIFY_GLUCOSE = 1 << 12
+VERIFY_PATIENT = 1 << 13
+
+NUTRITION_FLAGS = NUTRITION_LIPIDS | NUTRITION_IRON | NUTRITION_VITAMIN_D | NUTRITION_GLUCOSE
+EXERCISE_FLAGS = EXERCISE_LIPIDS | EXERCISE_IRON | EXERCISE_GLUCOSE
+VERIFY_FLAGS = (
+    VERIFY_REFERENCE_RANGE | VERIFY_RESULT | VERIFY_UNITS | VERIFY_LAB
+    | VERIFY_HEMOGLOBIN | VERIFY_GLUCOSE | VERIFY_PATIENT
+)
 
-    if "glucose" in report_lower or "hba1c" in report_lower:
-        suggestions.append("For blood sugar management: Focus on complex carbohydrates and fiber while limiting processed sugars.")
+KEYWORD_FLAGS = {
+    "cholesterol": NUTRITION_LIPIDS | EXERCISE_LIPIDS,
+    "lipid": NUTRITION_LIPIDS | EXERCISE_LIPIDS,
+    "triglycerides": NUTRITION_LIPIDS,
+    "hemoglobin": NUTRITION_IRON | EXERCISE_IRON | VERIFY_HEMOGLOBIN,
+    "ferritin": NUTRITION_IRON,
+    "iron": NUTRITION_IRON | EXERCISE_IRON,
+    "vitamin d": NUTRITION_VITAMIN_D,
+    "25-hydroxy": NUTRITION_VITAMIN_D,
+    "glucose": NUTRITION_GLUCOSE | EXERCISE_GLUCOSE | VERIFY_GLUCOSE,
+    "hba1c": NUTRITION_GLUCOSE | EXERCISE_GLUCOSE,
+    "reference range": VERIFY_REFERENCE_RANGE,
+    "result": VERIFY_RESULT,
+    "units": VERIFY_UNITS,
+    "lab": VERIFY_LAB,
+    "patient": VERIFY_PATIENT,
+}
+ALL_FLAGS = 0
+for _flags in KEYWORD_FLAGS.values():
+    ALL_FLAGS |= _flags
+
+# A single case-insensitive alternation compiled once; the zero-width lookahead
+# reports every keyword occurrence (including overlapping ones) in one pass.
+# Each keyword gets its own group, so a match's group index maps straight to
+# its flags without lowercasing or hashing the matched text.
+KEYWORD_PATTERN = re.compile(
+    "(?=" + "|".join(f"({re.escape(keyword)})" for keyword in KEYWORD_FLAGS) + ")",
+    re.IGNORECASE | re.ASCII,
+)
+GROUP_FLAGS = (0, *KEYWORD_FLAGS.values())
 
-    if not suggestions:
-        suggestions.append("Maintain a balanced diet with a variety of whole foods, focusing on lean proteins, vegetables, and whole grains.")
 
-    suggestions.append("Always consult a certified nutritionist or doctor before making significant dietary changes.")
-    return "\n".join(suggestions)
+def scan_keywords(text: str) -> int:
+    """Scan the report once and return the OR of the flags for every keyword found."""
+    found = 0
+    for match in KEYWORD_PATTERN.finditer(text):
+        found |= GROUP_FLAGS[match.lastindex]
+        if found == ALL_FLAGS:
+            break
+    return found
 
 
-@tool("Generate Exercise Plan from Blood Report")
-def generate_exercise_plan(blood_report: str) -> str:
-    """Interprets key health indicators and offers exercise suggestions tailored to metabolic and cardiovascular status."""
-    suggestions = []
-    report_lower = blood_report.lower()
+NUTRITION_SUGGESTIONS = (
+    (NUTRITION_LIPIDS, "For elevated lipid markers: Reduce saturated fats and increase soluble fiber (oats, legumes, fruits)."),
+    (NUTRITION_IRON, "For low iron markers: Prioritize iron-rich foods like spinach, lentils, or lean proteins, paired with Vitamin C for better absorption."),
+    (NUTRITION_VITAMIN_D, "For Vitamin D concerns: Include fortified dairy, egg yolks, and fatty fish. Consider safe sun exposure."),
+    (NUTRITION_GLUCOSE, "For blood sugar management: Focus on complex carbohydrates and fiber while limiting processed sugars."),
+)
+NUTRITION_DEFAULT = "Maintain a balanced diet with a variety of whole foods, focusing on lean proteins, vegetables, and whole grains."
+NUTRITION_DISCLAIMER = "Always consult a certified nutritionist or doctor before making significant dietary changes."
+
+EXERCISE_SUGGESTIONS = (
+    (EXERCISE_LIPIDS, "To support lipid profiles: Engage in 150 minutes of moderate aerobic activity (brisk walking, swimming) per week."),
+    (EXERCISE_IRON, "If iron is low: Focus on low-impact movement and prioritize recovery to avoid excessive fatigue."),
+    (EXERCISE_GLUCOSE, "For metabolic health: Combine aerobic exercise with twice-weekly resistance training to improve insulin sensitivity."),
+)
+EXERCISE_DEFAULT = "General recommendation: Aim for a mix of cardiovascular exercise and strength training most days of the week."
+EXERCISE_DISCLAIMER = "Always obtain medical clearance before beginning any new fitness regimen."
 
-    if "cholesterol" in report_lower or "lipid" in report_lower:
-        suggestions.append("To support lipid profiles: Engage in 150 minutes of moderate aerobic activity (brisk walking, swimming) per week.")
 
-    if "hemoglobin" in report_lower or "iron" in report_lower:
-        suggestions.append("If iron is low: Focus on low-impact movement and prioritize recovery to avoid excessive fatigue.")
+@lru_cache(maxsize=256)
+def render_suggestions(suggestions, default, disclaimer, found):
+    """Join the suggestions selected by `found` into the tool's response; cached per flag combination."""
+    lines = [text for flag, text in suggestions if found & flag] or [default]
+    lines.append(disclaimer)
+    return "\n".join(lines)
 
-    if "glucose" in report_lower or "hba1c" in report_lower:
-        suggestions.append("For metabolic health: Combine aerobic exercise with twice-weekly resistance training to improve insulin sensitivity.")
 
-    if not suggestions:
-        suggestions.append("General recommendation: Aim for a mix of cardiovascular exercise and strength training most days of the week.")
+@tool("Analyze Blood Report for Nutrition Guidance")
+def analyze_nutrition(blood_report: str) -> str:
+    """Reviews blood test data and returns dietary suggestions based on identified biomarker patterns."""
+    found = scan_keywords(blood_report) & NUTRITION_FLAGS
+    return render_suggestions(NUTRITION_SUGGESTIONS, NUTRITION_DEFAULT, NUTRITION_DISCLAIMER, found)
 
-    suggestions.append("Always obtain medical clearance before beginning any new fitness regimen.")
-    return "\n".join(suggestions)
+
+@tool("Generate Exercise Plan from Blood Report")
+def generate_exercise_plan(blood_report: str) -> str:
+    """Interprets key health indicators and offers exercise suggestions tailored to metabolic and cardiovascular status."""
+    found = scan_keywords(blood_report) & EXERCISE_FLAGS
+    return render_suggestions(EXERCISE_SUGGESTIONS, EXERCISE_DEFAULT, EXERCISE_DISCLAIMER, found)
 
 
 @tool("Verify Uploaded Blood Report")
 def verify_report(blood_text: str) -> str:
     """Scans the report for signs of authenticity — looks for structured lab panels, biomarkers, and references."""
-    keywords = ["Reference Range", "Result", "Units", "Lab", "Hemoglobin", "Glucose", "Patient"]
-    hits = sum(1 for word in keywords if word.lower() in blood_text.lower())
+    hits = (scan_keywords(blood_text) & VERIFY_FLAGS).bit_count()
     if hits >= 3:
         return "✅ Document appears to be a valid medical report with standard blood panel structure."
     return "⚠️ This may not be a typical blood report. Please ensure the uploaded file is a valid diagnostic document."
@@ -68,11 +128,43 @@ def verify_report(blood_text: str) -> str:
 
 # ---------- LOCAL LLM via Ollama ----------
 
-llm = ChatOllama(model="ollama/mistral", temperature=0.3)
+# One pooled HTTP client shared by every agent; its connection limit also caps
+# how many LLM calls can be in flight at once across concurrent crews. Keep it
+# close to the server's OLLAMA_NUM_PARALLEL: calls beyond the limit wait for a
+# free connection (no pool timeout) instead of queueing inside Ollama, where
+# the wait would count against the read timeout.
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "8"))
+OLLAMA_TIMEOUT = httpx.Timeout(float(os.getenv("OLLAMA_TIMEOUT", "600")), connect=5.0, pool=None)
+
+ollama_client = HTTPHandler(client=httpx.Client(
+    limits=httpx.Limits(
+        max_connections=OLLAMA_MAX_CONNECTIONS,
+        max_keepalive_connections=OLLAMA_MAX_CONNECTIONS // 2,
+    ),
+    timeout=OLLAMA_TIMEOUT,
+))
+
+# ollama_chat/ talks to Ollama's native chat API, which honours keep_alive.
+# keep_alive=-1 keeps the model loaded between agents instead of reloading it,
+# and a larger context window avoids truncating backstory + report prompts.
+llm = LLM(
+    model=os.getenv("OLLAMA_MODEL", "ollama_chat/mistral"),
+    base_url=os.getenv("OLLAMA_BASE_URL", "http://localhost:11434"),
+    temperature=0.3,
+    timeout=OLLAMA_TIMEOUT,
+    client=ollama_client,
+    keep_alive=-1,
+    num_ctx=int(os.getenv("OLLAMA_NUM_CTX", "8192")),
+    num_batch=512,
+)
 
 
 # ---------- AGENTS ----------
 
+# The system prompt is "role + backstory + goal", so backstories stay free of
+# {query}: the per-request text only appears in the goal, after a prefix that is
+# identical across requests and can be reused by Ollama's prompt cache.
+
 doctor = Agent(
     role="Medical Report Analyst",
     goal="Interpret blood test results clearly and responsibly, addressing the user's specific query: {query}",
@@ -80,7 +172,7 @@ doctor = Agent(
     memory=True,
     backstory=(
         "You are a clinical analyst specializing in blood diagnostics. "
-        "Your priority is to answer the patient's specific question ({query}) using the provided lab data. "
+        "Your priority is to answer the patient's specific question using the provided lab data. "
         "You explain markers clearly but never diagnose. You always recommend a physician follow-up."
     ),
     tools=[],
@@ -110,13 +202,12 @@ nutritionist = Agent(
     memory=True,
     backstory=(
         "You are a dietitian who interprets blood results to answer patient questions about food and nutrition. "
-        "You prioritize answering the user's specific query: '{query}' based on their lab markers."
+        "You prioritize answering the user's specific query based on their lab markers."
     ),
     tools=[analyze_nutrition],
     llm=llm,
     allow_delegation=False,
-    max_iter=3,
-    max_rpm=10
+    max_iter=3
 )
 
 
@@ -131,7 +222,6 @@ exercise_specialist = Agent(
     tools=[generate_exercise_plan],
     llm=llm,
     allow_delegation=False,
-    max_rpm=10,
     max_iter=3
 )
 
@@ -143,7 +233,7 @@ summary_agent = Agent(
     backstory=(
         "You are the final point of contact for the patient. You take the detailed analyses from the doctor, "
         "nutritionist, and exercise specialist and distill them into a clear, direct answer to the user's "
-        "original question: '{query}'. You cut through the technical jargon to provide actionable advice "
+        "original question. You cut through the technical jargon to provide actionable advice "
         "that specifically addresses what the user asked."
     ),
     tools=[],
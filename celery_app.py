@@ -17,12 +17,15 @@ celery_app = Celery(
 
 # Configure task handling
 celery_app.conf.update(
-    task_serializer="json",
-    result_serializer="json",
-    accept_content=["json"],
+    task_serializer="msgpack",
+    result_serializer="msgpack",
+    accept_content=["msgpack", "json"],
+    result_accept_content=["msgpack", "json"],
+    result_compression="zstd",
     timezone="UTC",
     enable_utc=True,
 
+    # Not enforced by the gevent pool, which only applies the hard limit
     task_soft_time_limit=600,
     task_time_limit=7200,
 
@@ -31,4 +34,12 @@ celery_app.conf.update(
     task_reject_on_worker_lost=True,
 
     result_expires=9000,
+
+    # LLM orchestration mostly waits on Ollama, so it gets its own queue
+    # served by a gevent pool (see README) instead of one process per task;
+    # CPU-bound embedding goes to a prefork pool so it never blocks that hub
+    task_routes={
+        "worker_tasks.process_blood_test_analysis": {"queue": "llm_io"},
+        "worker_tasks.add_report_to_memory": {"queue": "cpu"},
+    },
 )
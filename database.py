@@ -1,16 +1,53 @@
 import os
-from datetime import datetime
-from sqlalchemy import create_engine, Column, String, Text, DateTime, LargeBinary
+import mmap
+import hashlib
+import logging
+import base64
+import binascii
+import atexit
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import orjson
+import zstandard
+from sqlalchemy import create_engine, event, func, inspect, select, text, Column, String, Text, DateTime, JSON, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from util.crypto import encrypt_file, decrypt_file
+from sqlalchemy.orm import sessionmaker, load_only
+from util.crypto import decrypt_file, encrypt_file
 
 # DB setup
 DATABASE_URL = "sqlite:///blood_analysis.db"
-engine = create_engine(DATABASE_URL)
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    json_serializer=lambda obj: orjson.dumps(obj).decode("utf-8"),
+    json_deserializer=orjson.loads,
+)
 SessionLocal = sessionmaker(bind=engine)
 
 Base = declarative_base()
+logger = logging.getLogger(__name__)
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Status updates are coalesced by a single writer thread and flushed together
+UPDATE_FLUSH_INTERVAL = 0.02
+TERMINAL_STATUSES = ("completed", "failed")
+_pending_updates = queue.Queue()
+_writer_lock = threading.Lock()
+_writer_thread = None
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Use WAL so commits don't block readers and skip the per-commit fsync."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.close()
 
 
 class AnalysisResult(Base):
@@ -20,91 +57,316 @@ class AnalysisResult(Base):
     task_id = Column(String, index=True)
     filename = Column(String, nullable=False)
     query = Column(Text, nullable=False)
-    result_json = Column(Text)
-    encrypted_file = Column(LargeBinary)  # PDF file encrypted
+    result_json = Column(JSON)
+    encrypted_path = Column(String)  # Encrypted PDF on disk
+    report_text = Column(LargeBinary)  # Extracted PDF text, zstd-compressed then encrypted
+    content_sha = Column(String, index=True)  # SHA-256 of the uploaded PDF
     status = Column(String, default="pending")
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=func.current_timestamp(), server_default=func.current_timestamp(), index=True)
+
+
+@contextmanager
+def db_session():
+    """Yield a session that is always closed, even if the block raises."""
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
 
 
 def create_tables():
     Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
+
+
+def _add_missing_columns():
+    """Add the columns and indexes introduced since an existing table was created."""
+    table = AnalysisResult.__table__
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+
+    with engine.begin() as conn:
+        for column in table.columns:
+            # SQLite can't add a column with a non-constant default
+            if column.name not in existing and column.server_default is None:
+                column_type = column.type.compile(engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def _legacy_ciphertext(data):
+    """
+    Return the raw ciphertext for a blob from the legacy encrypted_file column.
+
+    The oldest rows stored the ciphertext as base64 text; raw nonce + ciphertext
+    bytes essentially never form valid base64, so anything that does decode is
+    treated as the old format.
+    """
+    try:
+        return base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        return data
+
 
+def migrate_schema(upload_dir):
+    """
+    Migrate data in an existing analysis_results table; run after create_tables.
 
-def create_analysis_record(id, filename, query, task_id, encrypted_file_bytes):
+    Encrypts report text that was stored only compressed, and moves encrypted
+    PDFs stored in the legacy encrypted_file column out to `upload_dir` as
+    `<sha256>.bin`, recording their path in encrypted_path and their hash in
+    content_sha.
+    """
+    table = AnalysisResult.__table__
+    inspector = inspect(engine)
+    if not inspector.has_table(table.name):
+        return
+    existing = {column["name"] for column in inspector.get_columns(table.name)}
+
+    with engine.begin() as conn:
+        # Report text written before it was encrypted is a bare zstd frame
+        plain = conn.execute(text(
+            f"SELECT id, report_text FROM {table.name} WHERE substr(report_text, 1, 4) = :magic"
+        ), {"magic": ZSTD_MAGIC}).all()
+        for analysis_id, report_text in plain:
+            conn.execute(
+                text(f"UPDATE {table.name} SET report_text = :report_text WHERE id = :id"),
+                {"report_text": encrypt_file(report_text), "id": analysis_id},
+            )
+
+    if "encrypted_file" not in existing:
+        return
+
+    os.makedirs(upload_dir, exist_ok=True)
+    with engine.begin() as conn:
+        ids = conn.execute(text(
+            f"SELECT id FROM {table.name} WHERE encrypted_file IS NOT NULL"
+        )).scalars().all()
+        for analysis_id in ids:
+            data = conn.execute(
+                text(f"SELECT encrypted_file FROM {table.name} WHERE id = :id"), {"id": analysis_id}
+            ).scalar_one()
+            data = _legacy_ciphertext(data)
+            try:
+                content_sha = hashlib.sha256(decrypt_file(data)).hexdigest()
+                path = os.path.join(upload_dir, f"{content_sha}.bin")
+            except ValueError:
+                logger.warning("Could not decrypt legacy file for analysis %s; keeping it by ID", analysis_id)
+                content_sha = None
+                path = os.path.join(upload_dir, f"{analysis_id}.bin")
+            if not os.path.exists(path):
+                with open(path, "wb") as f:
+                    f.write(data)
+            conn.execute(
+                text(
+                    f"UPDATE {table.name} SET encrypted_path = :path, content_sha = :sha, encrypted_file = NULL "
+                    "WHERE id = :id"
+                ),
+                {"path": path, "sha": content_sha, "id": analysis_id},
+            )
+        conn.execute(text(f"ALTER TABLE {table.name} DROP COLUMN encrypted_file"))
+    logger.info("Moved %d encrypted file(s) out of the database into %s", len(ids), upload_dir)
+
+
+def create_analysis_record(id, filename, query, task_id, encrypted_path, report_text, content_sha):
     """Create a new analysis record in the database."""
-    session = SessionLocal()
-    result = AnalysisResult(
-        id=id,
-        task_id=task_id,
-        filename=filename,
-        query=query,
-        encrypted_file=encrypted_file_bytes,
-        status="queued"
-    )
-    session.add(result)
-    session.commit()
-    session.close()
+    with db_session() as session:
+        result = AnalysisResult(
+            id=id,
+            task_id=task_id,
+            filename=filename,
+            query=query,
+            encrypted_path=encrypted_path,
+            report_text=encrypt_file(zstandard.ZstdCompressor(level=3).compress(report_text.encode("utf-8"))),
+            content_sha=content_sha,
+            status="queued"
+        )
+        session.add(result)
+        session.commit()
 
 
 def update_analysis(task_id, status, result_json=None):
-    """Update analysis status and result."""
-    session = SessionLocal()
-    result = session.query(AnalysisResult).filter_by(task_id=task_id).first()
-    if result:
-        result.status = status
+    """
+    Record an analysis status/result update.
+
+    Intermediate statuses are queued for the background writer. Terminal
+    statuses carry the result, so they are written before returning (after
+    any queued updates, which would otherwise overwrite them) and a failed
+    write raises to the caller.
+    """
+    if status in TERMINAL_STATUSES:
+        flush_updates()
+        _write_updates([(task_id, status, result_json)])
+        return
+    _ensure_writer()
+    _pending_updates.put((task_id, status, result_json))
+
+
+def flush_updates():
+    """Block until every queued update has been written to the database."""
+    if _writer_thread is not None and _writer_thread.is_alive():
+        _pending_updates.join()
+
+
+def _ensure_writer():
+    # Started lazily so each (forked) worker process gets its own writer
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_write_updates_forever, name="analysis-writer", daemon=True)
+            _writer_thread.start()
+
+
+def _write_updates_forever():
+    while True:
+        batch = [_pending_updates.get()]
+        time.sleep(UPDATE_FLUSH_INTERVAL)
+        while True:
+            try:
+                batch.append(_pending_updates.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _write_updates(batch)
+        except Exception as e:
+            print(f"[ERROR] Failed to write analysis updates: {e}")
+        finally:
+            for _ in batch:
+                _pending_updates.task_done()
+
+
+def _write_updates(batch):
+    """Apply a batch of updates in one transaction, keeping only the latest status per task."""
+    latest = {}
+    for task_id, status, result_json in batch:
+        values = latest.setdefault(task_id, {})
+        values["status"] = status
         if result_json:
-            result.result_json = result_json
+            values["result_json"] = result_json
+
+    with db_session() as session:
+        ids = dict(session.execute(
+            select(AnalysisResult.task_id, AnalysisResult.id).where(AnalysisResult.task_id.in_(latest))
+        ).all())
+        session.bulk_update_mappings(
+            AnalysisResult,
+            [{"id": ids[task_id], **values} for task_id, values in latest.items() if task_id in ids]
+        )
         session.commit()
-    session.close()
 
 
-def save_analysis(id, filename, query, result_json, file_path, status="completed"):
-    """Encrypt and store analysis result and file."""
-    with open(file_path, "rb") as f:
-        file_bytes = f.read()
-    encrypted_string = encrypt_file(file_bytes)
+atexit.register(flush_updates)
 
-    session = SessionLocal()
-    result = AnalysisResult(
-        id=id,
-        filename=filename,
-        query=query,
-        result_json=result_json,
-        encrypted_file=encrypted_string.encode("utf-8"),
-        status=status
-    )
-    session.add(result)
-    session.commit()
-    session.close()
-
-
-def get_all_analyses():
-    """Retrieve all analysis records from the database."""
-    session = SessionLocal()
-    results = session.query(AnalysisResult).order_by(AnalysisResult.created_at.desc()).all()
-    session.close()
+
+def get_analyses(limit=50, offset=0):
+    """Retrieve a page of analysis records, newest first, without the report text."""
+    with db_session() as session:
+        results = session.execute(
+            select(AnalysisResult)
+            .options(load_only(
+                AnalysisResult.id,
+                AnalysisResult.task_id,
+                AnalysisResult.filename,
+                AnalysisResult.query,
+                AnalysisResult.status,
+                AnalysisResult.created_at,
+                AnalysisResult.result_json,
+            ))
+            .order_by(AnalysisResult.created_at.desc())
+            .limit(limit)
+            .offset(offset)
+        ).scalars().all()
     return results
 def retrieve_encrypted_file(analysis_id: str):
     """Decrypt and return the original file contents."""
-    session = SessionLocal()
-    result = session.query(AnalysisResult).filter_by(id=analysis_id).first()
-    session.close()
+    with db_session() as session:
+        result = session.query(AnalysisResult).filter_by(id=analysis_id).first()
 
-    if result and result.encrypted_file:
-        try:
-            # result.encrypted_file is stored as bytes(base64_encoded_string)
-            encrypted_data_str = result.encrypted_file.decode("utf-8")
-            decrypted_data = decrypt_file(encrypted_data_str)
-            return decrypted_data, result.filename
-        except Exception as e:
-            raise ValueError("Decryption failed") from e
-    else:
+    if not (result and result.encrypted_path and os.path.exists(result.encrypted_path)):
         raise FileNotFoundError("Analysis ID not found or file missing")
+
+    try:
+        # Decrypt straight from the mapped file, then drop it from the page cache
+        with open(result.encrypted_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as data:
+                    decrypted_data = decrypt_file(data)
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        return decrypted_data, result.filename
+    except Exception as e:
+        raise ValueError("Decryption failed") from e
     
 def get_analysis_by_id(analysis_id: str):
     """Retrieve analysis record from the database by ID"""
-    session = SessionLocal()
-    result = session.query(AnalysisResult).filter_by(id=analysis_id).first()
-    session.close()
+    with db_session() as session:
+        result = session.query(AnalysisResult).filter_by(id=analysis_id).first()
     return result
 
+
+def get_analysis_by_task_id(task_id: str):
+    """Retrieve analysis record (without the report text) by Celery task ID"""
+    with db_session() as session:
+        result = session.execute(
+            select(AnalysisResult)
+            .options(load_only(
+                AnalysisResult.id,
+                AnalysisResult.task_id,
+                AnalysisResult.filename,
+                AnalysisResult.query,
+                AnalysisResult.status,
+                AnalysisResult.created_at,
+                AnalysisResult.result_json,
+            ))
+            .filter_by(task_id=task_id)
+            .limit(1)
+        ).scalar_one_or_none()
+    return result
+
+
+def get_report_text(analysis_id: str) -> str:
+    """Return the extracted report text stored at upload time."""
+    with db_session() as session:
+        report_text = session.execute(
+            select(AnalysisResult.report_text).filter_by(id=analysis_id)
+        ).scalar_one_or_none()
+
+    if report_text is None:
+        raise FileNotFoundError("Analysis ID not found or report text missing")
+    return _load_report_text(report_text)
+
+
+def get_report_text_by_content(content_sha: str):
+    """Return the extracted text of an earlier upload of the same PDF, or None."""
+    with db_session() as session:
+        report_text = session.execute(
+            select(AnalysisResult.report_text)
+            .where(AnalysisResult.content_sha == content_sha, AnalysisResult.report_text.is_not(None))
+            .limit(1)
+        ).scalar_one_or_none()
+
+    if report_text is None:
+        return None
+    return _load_report_text(report_text)
+
+
+def _load_report_text(report_text):
+    return zstandard.ZstdDecompressor().decompress(decrypt_file(report_text)).decode("utf-8")
+
+
+def find_completed_analysis(content_sha: str, query: str):
+    """Retrieve a completed analysis of the same PDF and query, if one exists."""
+    with db_session() as session:
+        result = session.execute(
+            select(AnalysisResult)
+            .options(load_only(AnalysisResult.id, AnalysisResult.task_id))
+            .where(
+                AnalysisResult.content_sha == content_sha,
+                AnalysisResult.query == query,
+                AnalysisResult.status == "completed",
+            )
+            .order_by(AnalysisResult.created_at.desc())
+            .limit(1)
+        ).scalar_one_or_none()
+    return result
@@ -1,20 +1,28 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, ORJSONResponse
 import os
 import uuid
+import hashlib
+import tempfile
+import asyncio
+import logging
 import traceback
-import json
 from celery.result import AsyncResult
 
 from celery_app import celery_app
 from worker_tasks import process_blood_test_analysis
-from util.crypto import encrypt_file, decrypt_file
-from database import get_analysis_by_id, create_analysis_record, get_all_analyses, update_analysis, SessionLocal, AnalysisResult
+from util.crypto import FileEncryptor, decrypt_file
+from database import get_analysis_by_id, get_analysis_by_task_id, create_analysis_record, get_analyses, update_analysis
+from database import find_completed_analysis, get_report_text_by_content, migrate_schema
 from tools import BloodTestReportTool
 
-app = FastAPI(title="Blood Test Report Analyser")
+logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+
+app = FastAPI(title="Blood Test Report Analyser", default_response_class=ORJSONResponse)
+logger = logging.getLogger(__name__)
 
 UPLOAD_DIR = "uploads"
+MAX_BUFFER_SIZE = 1 << 20
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.environ["OTEL_SDK_DISABLED"] = "true"
 from database import create_tables
@@ -22,6 +30,7 @@ from database import create_tables
 @app.on_event("startup")
 def init():
     create_tables()
+    migrate_schema(UPLOAD_DIR)
 
 
 @app.get("/")
@@ -39,36 +48,73 @@ async def analyze_blood_report(
             raise HTTPException(status_code=400, detail="Only PDF files are supported.")
 
         file_id = str(uuid.uuid4())
+        query = query.strip()
         
-        content = await file.read()
-
-        # ✅ Use BloodTestReportTool to read content from PDF bytes
-        reader = BloodTestReportTool()
-        blood_text = reader.read_pdf_bytes(file_bytes=content)
-
-
-        if not blood_text.strip():
-            raise HTTPException(status_code=400, detail="Uploaded PDF has no readable text.")
-
-        # ✅ Encrypt the raw bytes of the original PDF
-        encrypted_string = encrypt_file(content)
-        print(f"[INFO] PDF encrypted successfully")
+        # ✅ Encrypt and hash the upload in 1 MiB chunks, streaming the ciphertext to disk
+        hasher = hashlib.sha256()
+        fd, partial_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                encryptor = FileEncryptor(out)
+
+                def consume(chunk):
+                    encryptor.update(chunk)
+                    hasher.update(chunk)
+
+                while chunk := await file.read(MAX_BUFFER_SIZE):
+                    await asyncio.to_thread(consume, chunk)
+                await asyncio.to_thread(encryptor.finalize)
+            content_sha = hasher.hexdigest()
+            logger.info("PDF encrypted successfully")
+
+            # ✅ Same PDF and query already analysed: return the existing result
+            existing = await asyncio.to_thread(find_completed_analysis, content_sha, query)
+            if existing:
+                return {
+                    "status": "completed",
+                    "task_id": existing.task_id,
+                    "analysis_id": existing.id,
+                    "file_processed": file.filename,
+                    "query": query
+                }
+
+            # ✅ Reuse text extracted from an earlier upload of the same PDF, else parse the spooled upload
+            blood_text = await asyncio.to_thread(get_report_text_by_content, content_sha)
+            if blood_text is None:
+                await file.seek(0)
+                reader = BloodTestReportTool()
+                blood_text = await asyncio.to_thread(reader.read_pdf_file, file.file)
+
+            if not blood_text.strip():
+                raise HTTPException(status_code=400, detail="Uploaded PDF has no readable text.")
+
+            # ✅ Keep the encrypted PDF on disk, named by content so re-uploads share one file
+            encrypted_path = os.path.join(UPLOAD_DIR, f"{content_sha}.bin")
+            if not os.path.exists(encrypted_path):
+                os.replace(partial_path, encrypted_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
 
         # ✅ Generate task_id beforehand
         task_id = str(uuid.uuid4())
 
         # ✅ Save task record in database FIRST
-        create_analysis_record(
+        await asyncio.to_thread(
+            create_analysis_record,
             id=file_id,
             filename=file.filename,
-            query=query.strip(),
+            query=query,
             task_id=task_id,
-            encrypted_file_bytes=encrypted_string.encode("utf-8") # Store as bytes in LargeBinary
+            encrypted_path=encrypted_path,
+            report_text=blood_text,
+            content_sha=content_sha
         )
 
-        # ✅ Queue Celery task with pre-extracted text
-        task = process_blood_test_analysis.apply_async(
-            args=[blood_text, query.strip()],
+        # ✅ Queue Celery task; the worker reads the extracted text from the record
+        task = await asyncio.to_thread(
+            process_blood_test_analysis.apply_async,
+            args=[file_id, query],
             task_id=task_id
         )
 
@@ -89,15 +135,30 @@ async def analyze_blood_report(
 
 
 @app.get("/status/{task_id}")
-async def get_task_status(task_id: str):
+async def get_task_status(task_id: str, request: Request, http_response: Response):
     try:
-        task_result = AsyncResult(task_id, app=celery_app)
-        status = task_result.status
+        db_record = await asyncio.to_thread(get_analysis_by_task_id, task_id)
+
+        # Completed results are final and already stored: skip the Celery backend
+        if db_record and db_record.status == "completed":
+            etag = f'"{task_id}-completed"'
+            headers = {"ETag": etag, "Cache-Control": "max-age=1"}
+            if request.headers.get("if-none-match") == etag:
+                return Response(status_code=304, headers=headers)
+            http_response.headers.update(headers)
+            return {
+                "task_id": task_id,
+                "status": "SUCCESS",
+                "analysis_id": db_record.id,
+                "filename": db_record.filename,
+                "query": db_record.query,
+                "created_at": db_record.created_at,
+                "result": db_record.result_json
+            }
 
-        # Also check database for extra info
-        session = SessionLocal()
-        db_record = session.query(AnalysisResult).filter_by(task_id=task_id).first()
-        session.close()
+        task_result = AsyncResult(task_id, app=celery_app)
+        # Fetching the status also caches the result once the task is ready
+        status = await asyncio.to_thread(lambda: task_result.status)
 
         response = {
             "task_id": task_id,
@@ -109,7 +170,7 @@ async def get_task_status(task_id: str):
                 "analysis_id": db_record.id,
                 "filename": db_record.filename,
                 "query": db_record.query,
-                "created_at": db_record.created_at.isoformat()
+                "created_at": db_record.created_at
             })
 
         if status == "SUCCESS":
@@ -124,9 +185,12 @@ async def get_task_status(task_id: str):
 
 
 @app.get("/history")
-async def get_all_task_history():
+async def get_all_task_history(
+    limit: int = Query(default=50, ge=1, le=500),
+    offset: int = Query(default=0, ge=0)
+):
     try:
-        records = get_all_analyses()
+        records = await asyncio.to_thread(get_analyses, limit, offset)
         history = []
         for r in records:
             history.append({
@@ -135,10 +199,10 @@ async def get_all_task_history():
                 "filename": r.filename,
                 "query": r.query,
                 "status": r.status,
-                "created_at": r.created_at.isoformat(),
-                "result": json.loads(r.result_json) if r.result_json else None
+                "created_at": r.created_at,
+                "result": r.result_json
             })
-        return {"history": history}
+        return {"history": history, "limit": limit, "offset": offset}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -74,13 +74,16 @@ specific_query_answer = Task(
     description=(
         "You have access to the doctor's analysis, the nutritionist's advice, and the exercise specialist's plan. "
         "Your final task is to answer the user's specific query: '{query}' as directly and concisely as possible. "
-        "Do not repeat all the technical details, but synthesize them into a clear answer for the user."
+        "Do not repeat all the technical details, but synthesize them into a clear answer for the user.\n\n"
+        "Doctor's analysis:\n{doctor_analysis}\n\n"
+        "Nutritionist's advice:\n{nutrition_advice}\n\n"
+        "Exercise specialist's plan:\n{exercise_plan}"
     ),
     expected_output=(
         "A clear, direct answer to the user's query: '{query}', synthesizing information from all previous tasks."
     ),
     agent=summary_agent,
     tools=[],
-    input_vars=["query", "blood_text"],
+    input_vars=["query", "doctor_analysis", "nutrition_advice", "exercise_plan"],
     async_execution=False
 )
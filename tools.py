@@ -24,14 +24,27 @@ class BloodTestReportTool:
         Returns:
             A cleaned text string containing the content of the PDF.
 
+        Raises:
+            ValueError: If the PDF parsing fails.
+        """
+        return self.read_pdf_file(io.BytesIO(file_bytes))
+
+    def read_pdf_file(self, file_obj) -> str:
+        """
+        Reads and extracts text from a seekable binary PDF file object.
+
+        Args:
+            file_obj: An open binary file-like object positioned at the PDF start.
+
+        Returns:
+            A cleaned text string containing the content of the PDF.
+
         Raises:
             ValueError: If the PDF parsing fails.
         """
         try:
-            # Create a byte stream from the input bytes
-            pdf_stream = io.BytesIO(file_bytes)
             # Initialize the PDF reader
-            reader = PdfReader(pdf_stream)
+            reader = PdfReader(file_obj)
 
             full_text = ""
             # Iterate through each page of the PDF
@@ -2,6 +2,7 @@
 
 import base64
 import os
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from dotenv import load_dotenv
 
@@ -18,17 +19,39 @@ try:
 except Exception as e:
     raise ValueError("Failed to decode ENCRYPTION_KEY. Must be base64-encoded 32-byte key.") from e
 
-def encrypt_file(file_bytes: bytes) -> str:
+def encrypt_file(file_bytes: bytes) -> bytes:
     aesgcm = AESGCM(KEY)
     nonce = os.urandom(12)
     encrypted = aesgcm.encrypt(nonce, file_bytes, None)
-    return base64.b64encode(nonce + encrypted).decode("utf-8")
+    return nonce + encrypted
 
-def decrypt_file(encrypted_data: str) -> bytes:
+class FileEncryptor:
+    """
+    Incrementally encrypts a file fed in chunks, writing the output to `out`.
+
+    Produces the same nonce + ciphertext + tag layout as encrypt_file,
+    so the result can be read back with decrypt_file.
+    """
+
+    def __init__(self, out):
+        self.nonce = os.urandom(12)
+        self._encryptor = Cipher(algorithms.AES(KEY), modes.GCM(self.nonce)).encryptor()
+        self._out = out
+        self._out.write(self.nonce)
+
+    def update(self, chunk: bytes) -> None:
+        self._out.write(self._encryptor.update(chunk))
+
+    def finalize(self) -> None:
+        self._out.write(self._encryptor.finalize())
+        self._out.write(self._encryptor.tag)
+
+def decrypt_file(data: bytes) -> bytes:
+    # Slices of a memoryview pin the underlying buffer; release them on the way
+    # out so a caller's mmap can still close when decryption fails.
     try:
-        data = base64.b64decode(encrypted_data)
-        nonce, ciphertext = data[:12], data[12:]
-        aesgcm = AESGCM(KEY)
-        return aesgcm.decrypt(nonce, ciphertext, None)
+        with memoryview(data) as view, view[12:] as ciphertext:
+            aesgcm = AESGCM(KEY)
+            return aesgcm.decrypt(bytes(view[:12]), ciphertext, None)
     except Exception as e:
         raise ValueError("Decryption failed.") from e
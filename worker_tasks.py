@@ -3,24 +3,95 @@ Celery worker tasks for Blood Test Analysis System (Encrypted + Vector Memory Ve
 """
 
 import time
-import json
+from concurrent.futures import ThreadPoolExecutor
+from celery.signals import worker_process_shutdown, worker_ready, worker_shutdown
 from celery_app import celery_app
 from crewai import Crew, Process
-from agents import doctor, verifier, nutritionist, exercise_specialist, summary_agent
+from agents import llm, doctor, verifier, nutritionist, exercise_specialist, summary_agent
 from task import help_patients, nutrition_analysis, exercise_planning, verification_task, specific_query_answer
 from util.crypto import decrypt_file
 from memory.faiss_memory import add_to_memory
 from tools import BloodTestReportTool
-from database import update_analysis
+from database import update_analysis, flush_updates, get_report_text
+
+
+@celery_app.task(ignore_result=True)
+def add_report_to_memory(analysis_id: str, query: str):
+    """
+    Embed a report into the FAISS vector store.
+
+    Embedding is CPU-bound, so it runs as its own task on the prefork `cpu`
+    queue rather than inside the gevent worker that runs the analyses.
+    """
+    add_to_memory(get_report_text(analysis_id), metadata={"source": "blood_report", "query": query})
+    print("[MEMORY] Blood test report added to FAISS vector store")
+
+
+@worker_ready.connect
+def warm_up_llm(**kwargs):
+    """Load the model into Ollama before the first task arrives."""
+    try:
+        llm.call("warmup")
+        print("[LLM] Model warmed up")
+    except Exception as e:
+        print(f"[WARN] LLM warm-up failed: {e}")
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_pending_updates(**kwargs):
+    """
+    Make sure queued status updates land before the process exits.
+
+    worker_process_shutdown is only sent by prefork children; the gevent
+    worker runs tasks in the main process and only sends worker_shutdown.
+    """
+    flush_updates()
+
+
+def _single_task_crew(agent, task):
+    """
+    Build a one-agent crew from fresh copies of the shared agent and task.
+
+    Kickoff interpolates the inputs into the task and agent and attaches
+    the crew and executor to them in place, so concurrent analyses in one
+    worker process must never run the module-level templates directly.
+    """
+    agent = agent.copy()
+    task = task.copy([agent], {})
+    return Crew(
+        agents=[agent],
+        tasks=[task],
+        process=Process.sequential,
+        verbose=True,
+        max_rpm=25,
+    )
+
+
+def _run_specialists(inputs):
+    """
+    Run the doctor, nutritionist and exercise specialist concurrently.
+
+    None of the three depends on another's output, so each crew is kicked off
+    on its own thread. If one fails, the others are still waited on before the
+    error is raised, so a retry never overlaps with orphaned LLM runs.
+    """
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix="specialist") as executor:
+        runs = [
+            executor.submit(_single_task_crew(doctor, help_patients).kickoff, inputs=inputs),
+            executor.submit(_single_task_crew(nutritionist, nutrition_analysis).kickoff, inputs=inputs),
+            executor.submit(_single_task_crew(exercise_specialist, exercise_planning).kickoff, inputs=inputs),
+        ]
+    return tuple(str(run.result()) for run in runs)
 
 
 @celery_app.task(bind=True, max_retries=2, default_retry_delay=60)
-def process_blood_test_analysis(self, blood_text: str, query: str):
+def process_blood_test_analysis(self, analysis_id: str, query: str):
     """
     Celery task to generate analysis from blood test text.
 
     Args:
-        blood_text (str): Extracted text from the blood test PDF.
+        analysis_id (str): ID of the analysis record holding the extracted report text.
         query (str): The user's question or prompt.
 
     Returns:
@@ -31,35 +102,41 @@ def process_blood_test_analysis(self, blood_text: str, query: str):
         update_analysis(self.request.id, "processing")
         start = time.time()
 
-        # Store parsed report in vector memory
-        add_to_memory(blood_text, metadata={"source": "blood_report", "query": query})
-        print("[MEMORY] Blood test report added to FAISS vector store")
-
-        # Setup CrewAI
-        crew = Crew(
-            agents=[verifier, doctor, nutritionist, exercise_specialist, summary_agent],
-            tasks=[verification_task, help_patients, nutrition_analysis, exercise_planning, specific_query_answer],
-            process=Process.sequential,
-            verbose=True,
-            max_rpm=25,
-        )
-
-        # Run CrewAI with inputs
-        results = crew.kickoff(inputs={"query": query, "blood_text": blood_text})
+        blood_text = get_report_text(analysis_id)
+
+        # Store parsed report in vector memory (once, not on every retry)
+        if not self.request.retries:
+            add_report_to_memory.delay(analysis_id, query)
+
+        inputs = {"query": query, "blood_text": blood_text}
+
+        # Stage 1: verify the document
+        verification = _single_task_crew(verifier, verification_task).kickoff(inputs=inputs)
+
+        # Stage 2: independent specialist analyses in parallel
+        doctor_analysis, nutrition_advice, exercise_plan = _run_specialists(inputs)
+
+        # Stage 3: synthesize the specialist outputs into a direct answer
+        direct_answer = _single_task_crew(summary_agent, specific_query_answer).kickoff(inputs={
+            "query": query,
+            "doctor_analysis": doctor_analysis,
+            "nutrition_advice": nutrition_advice,
+            "exercise_plan": exercise_plan,
+        })
         duration = time.time() - start
 
         print(f"[SUCCESS] Analysis completed in {duration:.2f}s")
 
         result_data = {
-            "verification_result": str(crew.tasks[0].output),
-            "doctor_analysis": str(crew.tasks[1].output),
-            "nutrition_advice": str(crew.tasks[2].output),
-            "exercise_plan": str(crew.tasks[3].output),
-            "direct_answer": str(crew.tasks[4].output),
+            "verification_result": str(verification),
+            "doctor_analysis": doctor_analysis,
+            "nutrition_advice": nutrition_advice,
+            "exercise_plan": exercise_plan,
+            "direct_answer": str(direct_answer),
             "processing_time": f"{duration:.2f} seconds"
         }
         
-        update_analysis(self.request.id, "completed", result_json=json.dumps(result_data))
+        update_analysis(self.request.id, "completed", result_json=result_data)
         
         return result_data
 